@@ -25,30 +25,157 @@
 
 
 import argparse
+import csv
+import io
+import json
+import os
+import struct
 import sys
+import threading
 import time
-from pathlib import Path
 
 import psutil
 
-children = []
+# Buffered log rows are handed to the log file once they exceed this many
+# characters, and the log file itself (which has a buffer of _LOG_BUFFER_SIZE
+# bytes) is flushed once this many nanoseconds have passed since the last flush.
+_FLUSH_BYTES = 64 * 1024
+_FLUSH_INTERVAL_NS = 1_000_000_000
+_LOG_BUFFER_SIZE = 1 << 20
+
+# struct codes for the column types used in the binary log format
+_STRUCT_CODES = {"<f8": "d", "<f4": "f", "<u4": "I", "<u8": "Q"}
+
+# Process statuses that indicate the monitored process has finished
+_DEAD_STATUSES = frozenset((psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD))
+
+# pr.children(recursive=True) walks the whole process table, so the list of
+# children is only refreshed every _CHILDREN_SCAN_INTERVAL seconds (or when
+# called for a different process than _last_children_pid).
+_CHILDREN_SCAN_INTERVAL = 1.0
+_last_children_scan = 0.0
+_last_children_pid = None
+
+children = {}
 
 
 def all_children(pr):
-    global children
+    global children, _last_children_scan, _last_children_pid
+
+    now = time.monotonic()
+    if pr.pid != _last_children_pid:
+        children = {}
+    elif now - _last_children_scan < _CHILDREN_SCAN_INTERVAL:
+        return children
+    _last_children_scan = now
+    _last_children_pid = pr.pid
 
     try:
         children_of_pr = pr.children(recursive=True)
     except Exception:  # pragma: no cover
         return children
 
+    # Forget about children that have exited since the last scan, before
+    # merging in the new ones, so that a child reusing the PID of an exited
+    # one isn't dropped along with it
+    for child_pid in [child_pid for child_pid, child in children.items() if not child.is_running()]:
+        del children[child_pid]
+
     for child in children_of_pr:
-        if child not in children:
-            children.append(child)
+        children.setdefault(child.pid, child)
 
     return children
 
 
+# Scanning a directory tree can take much longer than a single sample, so the
+# size of --include-dir is refreshed in a background thread at this interval.
+_DIR_SCAN_INTERVAL = 2.0
+
+# Directory listings are cached between scans, but only reused if they were
+# taken at least this long after the last modification of the directory.
+_DIR_MTIME_RESOLUTION_NS = 2_000_000_000
+
+# When sampling adaptively, the interval is doubled each time this many
+# consecutive samples have the same CPU and memory usage, and is never
+# shorter than _MIN_INTERVAL seconds.
+_ADAPTIVE_UNCHANGED_SAMPLES = 5
+_MIN_INTERVAL = 0.001
+
+# Initial and maximum number of samples kept for each plotted quantity. Once
+# the maximum is reached, every other sample is dropped and only every other
+# new sample is recorded, so memory use stays bounded for long recordings.
+_LOG_INITIAL_SIZE = 1024
+_LOG_MAX_SIZE = 65536
+
+
+def list_dir(path):
+
+    # os.scandir() gives the entry types from the directory listing itself, so
+    # no stat() call is needed to tell subdirectories and files apart.
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(entry.path)
+            except OSError:
+                # If the directory content is actively changing, the entry might be gone
+                continue
+    return subdirs, files
+
+
+def get_dir_size_mb(path, listings=None):
+
+    # If given, listings caches the subdirectories and files of each directory
+    # along with the directory mtime, and a directory is only listed again
+    # once its mtime changes (i.e. entries were added, removed or renamed).
+    # File sizes can change without touching the directory mtime, so every
+    # file is still stat'ed.
+    if listings is None:
+        listings = {}
+    visited = {}
+    total = 0
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            cached = listings.get(directory)
+            if cached is not None and cached[0] == mtime_ns:
+                _, listed_ns, subdirs, files = cached
+            else:
+                listed_ns = time.time_ns()
+                subdirs, files = list_dir(directory)
+        except OSError:
+            continue
+        # A directory changed again within the mtime resolution of the
+        # filesystem would keep the same mtime, so a listing is only
+        # reused once it was taken well after the last change.
+        if listed_ns - mtime_ns > _DIR_MTIME_RESOLUTION_NS:
+            visited[directory] = (mtime_ns, listed_ns, subdirs, files)
+        stack.extend(subdirs)
+        for file in files:
+            try:
+                total += os.stat(file, follow_symlinks=False).st_size
+            except OSError:
+                continue
+    # Forget directories that no longer exist
+    listings.clear()
+    listings.update(visited)
+    return total / 1024**2
+
+
+def watch_dir_size(path, dir_size, stop, listings):
+
+    # Keep dir_size["mb"] up to date until the stop event is set
+    while True:
+        dir_size["mb"] = get_dir_size_mb(path, listings)
+        if stop.wait(_DIR_SCAN_INTERVAL):
+            break
+
+
 def get_unique_path_mmap_rss(proc):
 
     unique_mappings = {}
@@ -87,10 +214,18 @@ def main():
         "--log-format",
         type=str,
         default="plain",
-        help='the format of the log file, can be one of "plain" or "csv"',
+        help='the format of the log file, can be one of "plain", "csv" or "binary". '
+        "The binary format is a JSON header line describing the columns, followed "
+        "by fixed-size little-endian records that can be read with numpy.",
     )
 
-    parser.add_argument("--plot", type=str, help="output the statistics to a plot.")
+    parser.add_argument(
+        "--plot",
+        type=str,
+        help="output the statistics to a plot. Swap usage is only recorded "
+        "in the log, so if --plot is given without --log it is not collected, "
+        "which avoids parsing the full memory map of the process on Linux.",
+    )
 
     parser.add_argument(
         "--duration",
@@ -104,8 +239,25 @@ def main():
         "--interval",
         type=float,
         help="how long to wait between each sample (in "
-        "seconds). By default the process is sampled "
-        "as often as possible.",
+        "seconds). By default the interval adapts between "
+        "--base-interval and --max-interval depending on "
+        "whether the CPU and memory usage are changing.",
+    )
+
+    parser.add_argument(
+        "--base-interval",
+        type=float,
+        default=0.1,
+        help="if --interval is not set, the interval (in seconds) used while the "
+        "CPU or memory usage is changing (default: %(default)s).",
+    )
+
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        default=1.0,
+        help="if --interval is not set, the interval (in seconds) is doubled up to "
+        "this value while the CPU and memory usage stay unchanged (default: %(default)s).",
     )
 
     parser.add_argument(
@@ -125,8 +277,24 @@ def main():
     parser.add_argument(
         "--include-dir",
         type=str,
-        help="include the working directory disk usage in statistics (results "
-        "in a slower maximum sampling rate).",
+        help="include the working directory disk usage in statistics (the size "
+        f"is refreshed in the background every {_DIR_SCAN_INTERVAL:g} seconds, and "
+        "is reported as nan until the first scan has completed).",
+    )
+
+    parser.add_argument(
+        "--pin-core",
+        type=int,
+        help="pin psrecord to the given CPU core, to keep it from competing with "
+        "the monitored process (Linux only). This only helps if the monitored "
+        "process is not itself pinned to that core.",
+    )
+
+    parser.add_argument(
+        "--nice",
+        type=int,
+        help="increase the niceness of psrecord by this amount, so that it runs "
+        "at a lower priority than the monitored process (not available on Windows).",
     )
 
     args = parser.parse_args()
@@ -150,11 +318,15 @@ def main():
         plot=args.plot,
         duration=args.duration,
         interval=args.interval,
+        base_interval=args.base_interval,
+        max_interval=args.max_interval,
         include_children=args.include_children,
         include_io=args.include_io,
         log_format=args.log_format,
         include_dir=args.include_dir,
         include_cache=args.include_cache,
+        pin_core=args.pin_core,
+        nice=args.nice,
     )
 
     if sprocess is not None:
@@ -167,80 +339,210 @@ def monitor(
     plot=None,
     duration=None,
     interval=None,
+    base_interval=0.1,
+    max_interval=1.0,
     include_children=False,
     include_io=False,
     log_format="plain",
     include_dir=None,
     include_cache=None,
+    pin_core=None,
+    nice=None,
 ):
 
-    global children
-    children = []  # Reset at start of monitoring
+    global children, _last_children_scan
+    children = {}  # Reset at start of monitoring
+    _last_children_scan = 0.0
 
     pr = psutil.Process(pid)
 
-    # Record start time
-    start_time = time.time()
+    # Reduce the impact of psrecord on the monitored process. Note that this
+    # applies to the process calling monitor() and is not undone afterwards.
+    if pin_core is not None:
+        if hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, {pin_core})
+            except (OSError, OverflowError, ValueError) as exc:
+                print(f"Warning: Could not pin to CPU core {pin_core}: {exc}")
+        else:  # pragma: no cover
+            print("Warning: Pinning to a CPU core is not supported on this platform.")
+    if nice:
+        if hasattr(os, "nice"):
+            try:
+                os.nice(nice)
+            except (OSError, OverflowError) as exc:
+                print(f"Warning: Could not change the niceness by {nice}: {exc}")
+        else:  # pragma: no cover
+            print("Warning: Changing the niceness is not supported on this platform.")
+
+    # Record start time. The monotonic clock can't jump backwards (e.g. on NTP
+    # adjustments) and integer nanoseconds avoid float rounding.
+    start_ns = time.monotonic_ns()
+    duration_ns = None if duration is None else int(duration * 1e9)
 
     f = None
+    buf = io.StringIO()
+    # Text is encoded before being written out, unless sys.stdout has been
+    # replaced by an object that only accepts text (e.g. io.StringIO)
+    encode_log = str.encode
     if logfile is None and plot is None:
-        f = sys.stdout
+        sys.stdout.flush()
+        f = getattr(sys.stdout, "buffer", None)
+        if f is None:
+            f = sys.stdout
+            encode_log = str
         logfile = "<stdout>"
     elif logfile is not None:
-        f = open(logfile, "w")
+        f = open(logfile, "wb", buffering=_LOG_BUFFER_SIZE)
 
     if logfile:
         if log_format == "plain":
-            f.write(
-                "# {:12s} {:12s} {:12s} {:12s} {:12s}".format(
-                    "Elapsed time".center(12),
-                    "CPU (%)".center(12),
-                    "Real (MB)".center(12),
-                    "Virtual (MB)".center(12),
-                    "Swap (MB)".center(12),
-                ),
+            header = "# {:12s} {:12s} {:12s} {:12s} {:12s}".format(
+                "Elapsed time".center(12),
+                "CPU (%)".center(12),
+                "Real (MB)".center(12),
+                "Virtual (MB)".center(12),
+                "Swap (MB)".center(12),
             )
             if include_io:
-                f.write(
-                    " {:12s} {:12s} {:12s} {:12s}".format(
-                        "Read count".center(12),
-                        "Write count".center(12),
-                        "Read (MB)".center(12),
-                        "Write (MB)".center(12),
-                    )
+                header += " {:12s} {:12s} {:12s} {:12s}".format(
+                    "Read count".center(12),
+                    "Write count".center(12),
+                    "Read (MB)".center(12),
+                    "Write (MB)".center(12),
                 )
             if include_dir:
-                f.write(" {:12s}".format("Dir size (MB)".center(12)))
+                header += " {:12s}".format("Dir size (MB)".center(12))
             if include_cache:
                 # RSS of memory-mapped files is part of real memory used by the process
-                f.write(" {:12s}".format("MMap_RSS (MB)".center(12)))
-                f.write(" {:12s}".format("Sys_Cache (GB)".center(12)))
-        elif log_format == "csv":
-            f.write("elapsed_time,nproc,cpu,mem_real,mem_virtual,mem_swap")
+                header += " {:12s}".format("MMap_RSS (MB)".center(12))
+                header += " {:12s}".format("Sys_Cache (GB)".center(12))
+        elif log_format in ("csv", "binary"):
+            header = "elapsed_time,nproc,cpu,mem_real,mem_virtual,mem_swap"
             if include_io:
-                f.write(",read_count,write_count,read_mb,write_mb")
+                header += ",read_count,write_count,read_mb,write_mb"
             if include_dir:
-                f.write(",dir_size_mb")
+                header += ",dir_size_mb"
             if include_cache:
-                f.write(",mmap_rss_mb")
-                f.write(",cache_size_gb")
+                header += ",mmap_rss_mb"
+                header += ",cache_size_gb"
         else:
+            if logfile != "<stdout>":
+                f.close()
             raise ValueError(
-                f"Unknown log format: '{log_format}', should be either 'plain' or 'csv'"
+                f"Unknown log format: '{log_format}', should be one of 'plain', "
+                "'csv' or 'binary'"
             )
-        f.write("\n")
 
-    log = {}
-    log["times"] = []
-    log["cpu"] = []
-    log["mem_real"] = []
-    log["mem_virtual"] = []
+        # Format of each column in the plain log, number of decimals kept in
+        # the CSV log, and type in the binary log, in the order the values are
+        # collected in the main loop. The number of processes is not included
+        # in the plain output.
+        columns = [
+            ("12.3f", 6, "<f8"),
+            (None, None, "<u4"),
+            ("12.3f", 2, "<f4"),
+            ("12.3f", 3, "<f4"),
+            ("12.3f", 3, "<f4"),
+            ("12.3f", 3, "<f4"),
+        ]
+        if include_io:
+            columns += [
+                ("12d", None, "<u8"),
+                ("12d", None, "<u8"),
+                ("12.3f", 3, "<f4"),
+                ("12.3f", 3, "<f4"),
+            ]
+        if include_dir:
+            columns += [("12.3f", 3, "<f4")]
+        if include_cache:
+            columns += [("12.3f", 3, "<f4"), ("12.3f", 3, "<f4")]
 
+        if log_format == "plain":
+            # Build the row template once, rather than parsing an f-string per sample
+            row_format = " ".join(
+                f"{{{i}:{spec}}}" for i, (spec, _, _) in enumerate(columns) if spec
+            )
+            format_row = (row_format + "\n").format
+            # Bound once here to avoid an attribute lookup per sample
+            write_buf = buf.write
+        elif log_format == "csv":
+            csv_digits = [digits for _, digits, _ in columns]
+            writerow = csv.writer(buf, lineterminator="\n").writerow
+        else:
+            if encode_log is str:
+                raise ValueError("The binary log format can't be written to a text-only stdout")
+            # Each sample is written as a fixed-size little-endian record. The
+            # header line is a JSON list of (name, type) pairs that can be
+            # passed to numpy.dtype() to read back the records.
+            dtypes = [dtype for _, _, dtype in columns]
+            header = json.dumps(list(zip(header.split(","), dtypes)))
+            record_format = "<" + "".join(_STRUCT_CODES[dtype] for dtype in dtypes)
+            pack_row = struct.Struct(record_format).pack
+            # The records bypass the text buffer and go straight into the
+            # (buffered) log file
+            write_record = f.write
+
+        f.write(encode_log(header + "\n"))
+
+    # Values to plot are stored in preallocated arrays that are grown
+    # geometrically up to _LOG_MAX_SIZE samples, with n_log the number of
+    # samples recorded so far and one in every log_stride samples recorded.
+    log = {}
+    n_log = 0
+    n_samples = 0
+    log_stride = 1
+    if plot:
+        # numpy is a dependency of matplotlib, so is available whenever plotting is
+        import numpy as np
+
+        log_keys = ["times", "cpu", "mem_real", "mem_virtual"]
+        if include_io:
+            log_keys += ["read_count", "write_count", "read_bytes", "write_bytes"]
+        if duration is not None and interval:
+            # The number of samples is known in advance
+            log_size = min(int(duration / interval) + 16, _LOG_MAX_SIZE)
+        else:
+            log_size = _LOG_INITIAL_SIZE
+        log = {key: np.empty(log_size, dtype=np.float64) for key in log_keys}
+
+    # on macOS, memory_full_info() doesn't provide process-specific swap info
+    # and might also introduce latency. On Linux it parses /proc/<pid>/smaps,
+    # which is much slower than memory_info(), so it is only used if the swap
+    # usage is actually written out.
+    if sys.platform == "linux" and logfile:
+        memory_attr = "memory_full_info"
+    else:
+        memory_attr = "memory_info"
+
+    child_attrs = ["cpu_percent", memory_attr]
     if include_io:
-        log["read_count"] = []
-        log["write_count"] = []
-        log["read_bytes"] = []
-        log["write_bytes"] = []
+        child_attrs.append("io_counters")
+    attrs = ["status"] + child_attrs
+
+    if include_dir:
+        # The directory size is logged as NaN until the background thread has
+        # completed its first scan, so that sampling can start right away
+        dir_listings = {}
+        dir_size = {"mb": float("nan")}
+        dir_stop = threading.Event()
+        threading.Thread(
+            target=watch_dir_size,
+            args=(include_dir, dir_size, dir_stop, dir_listings),
+            daemon=True,
+        ).start()
+
+    last_flush_ns = 0
+    finished_time = None
+
+    # If no fixed interval is given, sample every base_interval while the
+    # process is active, and back off towards max_interval while it is idle.
+    if interval is None:
+        base_interval = max(base_interval, _MIN_INTERVAL)
+        max_interval = max(max_interval, base_interval)
+        current_interval = base_interval
+        last_sample = None
+        n_unchanged = 0
 
     try:
         # Start main event loop
@@ -249,33 +551,31 @@ def monitor(
             with pr.oneshot():
 
                 # Find current time
-                current_time = time.time()
-                elapsed_time = current_time - start_time
+                elapsed_ns = time.monotonic_ns() - start_ns
+                elapsed_time = elapsed_ns / 1e9
 
+                # Fetch status, CPU, memory (and I/O) in a single call
                 try:
-                    pr_status = pr.status()
-                except psutil.NoSuchProcess:  # pragma: no cover
-                    break
+                    stats = pr.as_dict(attrs=attrs, ad_value=None)
+                except psutil.NoSuchProcess:
+                    # The process was reaped between samples
+                    pr_status = psutil.STATUS_DEAD
+                else:
+                    pr_status = stats["status"]
 
                 # Check if process status indicates we should exit
-                if pr_status in [psutil.STATUS_ZOMBIE, psutil.STATUS_DEAD]:
-                    print(f"Process finished ({elapsed_time:.2f} seconds)")
+                if pr_status in _DEAD_STATUSES:
+                    finished_time = elapsed_time
                     break
 
                 # Check if we have reached the maximum time
-                if duration is not None and elapsed_time > duration:
+                if duration_ns is not None and elapsed_ns > duration_ns:
                     break
 
                 # Get current CPU and memory
-                try:
-                    current_cpu = pr.cpu_percent()
-                    # on macOS, memory_full_info() doesn't provide process-specific swap info
-                    # and might also introduce latency.
-                    if sys.platform == "linux":
-                        current_mem = pr.memory_full_info()
-                    else:
-                        current_mem = pr.memory_info()
-                except Exception:
+                current_cpu = stats["cpu_percent"]
+                current_mem = stats[memory_attr]
+                if current_cpu is None or current_mem is None:
                     break
                 current_mem_real = current_mem.rss / 1024. ** 2
                 current_mem_virtual = current_mem.vms / 1024. ** 2
@@ -288,7 +588,11 @@ def monitor(
                         current_mmap_rss = 0.0
 
                 if include_io:
-                    counters = pr.io_counters()
+                    counters = stats["io_counters"]
+                    if counters is None:
+                        # as_dict() hides AccessDenied, but without I/O access for
+                        # the monitored process there is nothing meaningful to log
+                        raise psutil.AccessDenied(pid, msg="cannot read I/O counters")
                     read_count = counters.read_count
                     write_count = counters.write_count
                     read_bytes = counters.read_bytes
@@ -298,45 +602,40 @@ def monitor(
 
                 # Get information for children
                 if include_children:
-                    for child in all_children(pr):
-                        with child.oneshot():
-                            try:
-                                current_cpu += child.cpu_percent()
-                                if sys.platform == "linux":
-                                    current_mem = child.memory_full_info()
-                                else:
-                                    current_mem = child.memory_info()
-                                current_mem_real += current_mem.rss / 1024. ** 2
-                                current_mem_virtual += current_mem.vms / 1024. ** 2
-                                # macOS uses a compressed memory system and unified paging,
-                                # so per-process swap is not easy to get
-                                # on macOS, current.swap doesn't exist
-                                current_mem_swap += getattr(current_mem, 'swap', 0) / 1024. ** 2
+                    snapshots = []
+                    for child in all_children(pr).values():
+                        try:
+                            with child.oneshot():
+                                child_stats = child.as_dict(attrs=child_attrs, ad_value=None)
                                 if include_cache:
-                                    current_mmap_rss += get_unique_path_mmap_rss(child)
-                                if include_io:
-                                    counters = child.io_counters()
-                                    read_count += counters.read_count
-                                    write_count += counters.write_count
-                                    read_bytes += counters.read_bytes
-                                    write_bytes += counters.write_bytes
-                                n_proc += 1
-                            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                                continue
+                                    child_stats["mmap_rss"] = get_unique_path_mmap_rss(child)
+                        except psutil.NoSuchProcess:
+                            continue
+                        # as_dict() returns None for anything we were denied access to
+                        if None not in child_stats.values():
+                            snapshots.append(child_stats)
+
+                    n_proc += len(snapshots)
+                    current_cpu += sum(snap["cpu_percent"] for snap in snapshots)
+                    child_mems = [snap[memory_attr] for snap in snapshots]
+                    current_mem_real += sum(mem.rss for mem in child_mems) / 1024. ** 2
+                    current_mem_virtual += sum(mem.vms for mem in child_mems) / 1024. ** 2
+                    # macOS uses a compressed memory system and unified paging,
+                    # so per-process swap is not easy to get
+                    # on macOS, current.swap doesn't exist
+                    current_mem_swap += (
+                        sum(getattr(mem, 'swap', 0) for mem in child_mems) / 1024. ** 2
+                    )
+                    if include_cache:
+                        current_mmap_rss += sum(snap["mmap_rss"] for snap in snapshots)
+                    if include_io:
+                        read_count += sum(snap["io_counters"].read_count for snap in snapshots)
+                        write_count += sum(snap["io_counters"].write_count for snap in snapshots)
+                        read_bytes += sum(snap["io_counters"].read_bytes for snap in snapshots)
+                        write_bytes += sum(snap["io_counters"].write_bytes for snap in snapshots)
 
             if include_dir:
-                try:
-                    # If the directory content is actively changing, the filescan and size calculation might fail.
-                    current_dir = (
-                        sum(
-                            file.stat().st_size
-                            for file in Path(include_dir).rglob("*")
-                            if file.is_file()
-                        )
-                        / 1024**2
-                    )
-                except (FileNotFoundError, OSError):
-                    current_dir = 0.0
+                current_dir = dir_size["mb"]
 
             if include_cache:
                 try:
@@ -347,85 +646,133 @@ def monitor(
                     current_cache = 0.0
 
             if logfile:
+                row = [
+                    elapsed_time,
+                    n_proc,
+                    current_cpu,
+                    current_mem_real,
+                    current_mem_virtual,
+                    current_mem_swap,
+                ]
+                if include_io:
+                    row += [read_count, write_count, read_bytes / 1024**2, write_bytes / 1024**2]
+                if include_dir:
+                    row.append(current_dir)
+                if include_cache:
+                    row += [current_mmap_rss, current_cache]
                 if log_format == "plain":
-                    f.write(
-                        f"{elapsed_time:12.3f} {current_cpu:12.3f}"
-                        f" {current_mem_real:12.3f} {current_mem_virtual:12.3f}"
-                        f" {current_mem_swap:12.3f}"
+                    write_buf(format_row(*row))
+                elif log_format == "binary":
+                    write_record(pack_row(*row))
+                else:
+                    writerow(
+                        [
+                            value if digits is None else round(value, digits)
+                            for value, digits in zip(row, csv_digits)
+                        ]
                     )
-                    if include_io:
-                        f.write(
-                            f" {read_count:12d} {write_count:12d}"
-                            f" {read_bytes/1024**2:12.3f} {write_bytes/1024**2:12.3f}"
-                        )
-                    if include_dir:
-                        f.write(f" {current_dir:12.3f}")
-                    if include_cache:
-                        f.write(f" {current_mmap_rss:12.3f} {current_cache:12.3f}")
 
-                elif log_format == "csv":
-                    f.write(
-                        f"{elapsed_time},{n_proc},{current_cpu},{current_mem_real},{current_mem_virtual},{current_mem_swap}"
-                    )
-                    if include_io:
-                        f.write(f",{read_count},{write_count},{read_bytes/1024**2},{write_bytes/1024**2}")
-                    if include_dir:
-                        f.write(f",{current_dir}")
-                    if include_cache:
-                        f.write(f",{current_mmap_rss},{current_cache}")
-                f.write("\n")
-                f.flush()
+                flush = elapsed_ns - last_flush_ns > _FLUSH_INTERVAL_NS
+                if flush or buf.tell() > _FLUSH_BYTES:
+                    f.write(encode_log(buf.getvalue()))
+                    buf.seek(0)
+                    buf.truncate()
+                if flush:
+                    f.flush()
+                    last_flush_ns = elapsed_ns
 
             if interval is not None:
                 time.sleep(interval)
+            else:
+                sample = (current_cpu, current_mem_real)
+                if sample != last_sample:
+                    current_interval = base_interval
+                    n_unchanged = 0
+                else:
+                    n_unchanged += 1
+                    if n_unchanged >= _ADAPTIVE_UNCHANGED_SAMPLES:
+                        current_interval = min(2 * current_interval, max_interval)
+                        n_unchanged = 0
+                last_sample = sample
+                time.sleep(current_interval)
 
             # If plotting, record the values
-            if plot:
-                log["times"].append(elapsed_time)
-                log["cpu"].append(current_cpu)
-                log["mem_real"].append(current_mem_real)
-                log["mem_virtual"].append(current_mem_virtual)
+            if plot and n_samples % log_stride == 0:
+                if n_log == log_size:
+                    if log_size < _LOG_MAX_SIZE:
+                        log_size = min(2 * log_size, _LOG_MAX_SIZE)
+                        for key in log:
+                            log[key] = np.resize(log[key], log_size)
+                    else:
+                        # Halve the time resolution. _LOG_MAX_SIZE is even, so the
+                        # current sample is still one to record with the new stride.
+                        n_log //= 2
+                        for values in log.values():
+                            values[:n_log] = values[::2]
+                        log_stride *= 2
+                log["times"][n_log] = elapsed_time
+                log["cpu"][n_log] = current_cpu
+                log["mem_real"][n_log] = current_mem_real
+                log["mem_virtual"][n_log] = current_mem_virtual
                 if include_io:
-                    log["read_count"].append(read_count)
-                    log["write_count"].append(write_count)
-                    log["read_bytes"].append(read_bytes)
-                    log["write_bytes"].append(write_bytes)
+                    log["read_count"][n_log] = read_count
+                    log["write_count"][n_log] = write_count
+                    log["read_bytes"][n_log] = read_bytes
+                    log["write_bytes"][n_log] = write_bytes
+                n_log += 1
+            n_samples += 1
 
     except KeyboardInterrupt:  # pragma: no cover
         pass
 
-    # close the logfile, if it's not stdout
-    if logfile and logfile != "<stdout>":
-        f.close()
+    finally:
+        if include_dir:
+            dir_stop.set()
+
+        # write out any remaining rows and close the logfile, if it's not stdout
+        if logfile:
+            f.write(encode_log(buf.getvalue()))
+            f.flush()
+            if logfile != "<stdout>":
+                f.close()
+
+    # Reported only once the buffered rows have been written out, so that it
+    # comes after them when logging to stdout
+    if finished_time is not None:
+        print(f"Process finished ({finished_time:.2f} seconds)")
 
     if plot:
 
-        if not log["times"]:
+        if n_log == 0:
             print("Warning: No data points were recorded. Skipping plot generation.")
             return
 
-        # Use non-interactive backend, to enable operation on headless machines
+        log = {key: values[:n_log] for key, values in log.items()}
+
+        # Draw with the Agg canvas directly rather than through pyplot, so that
+        # no GUI backend is loaded and this works on headless machines.
         # We import matplotlib here so that the module can be imported even if
         # matplotlib is not present and the plotting option is unset
-        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
 
-        with plt.rc_context({"backend": "Agg"}):
-            fig = plt.figure()
-            ax = fig.add_subplot(1, 1, 1)
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(1, 1, 1)
 
-            ax.plot(log["times"], log["cpu"], "-", lw=1, color="r")
+        ax.plot(log["times"], log["cpu"], "-", lw=1, color="r")
 
-            ax.set_ylabel("CPU (%)", color="r")
-            ax.set_xlabel("time (s)")
-            ax.set_ylim(0.0, max(log["cpu"]) * 1.2)
+        ax.set_ylabel("CPU (%)", color="r")
+        ax.set_xlabel("time (s)")
+        ax.set_ylim(0.0, log["cpu"].max() * 1.2)
 
-            ax2 = ax.twinx()
+        ax2 = ax.twinx()
 
-            ax2.plot(log["times"], log["mem_real"], "-", lw=1, color="b")
-            ax2.set_ylim(0.0, max(log["mem_real"]) * 1.2)
+        ax2.plot(log["times"], log["mem_real"], "-", lw=1, color="b")
+        ax2.set_ylim(0.0, log["mem_real"].max() * 1.2)
 
-            ax2.set_ylabel("Real Memory (MB)", color="b")
+        ax2.set_ylabel("Real Memory (MB)", color="b")
 
-            ax.grid()
+        ax.grid()
 
-            fig.savefig(plot)
+        fig.savefig(plot)
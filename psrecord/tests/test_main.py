@@ -1,12 +1,17 @@
+import contextlib
 import csv
+import io
+import json
 import os
+import struct
 import subprocess
 import sys
+import threading
 
 import psutil
 import pytest
 
-from ..main import all_children, main, monitor
+from ..main import all_children, get_dir_size_mb, main, monitor
 
 TEST_CODE = """
 import subprocess
@@ -30,9 +35,78 @@ def test_all_children(tmpdir):
     pr = psutil.Process(p.pid)
     children = all_children(pr)
     assert len(children) > 0
+    assert all(child.pid == pid for pid, child in children.items())
     p.kill()
 
 
+def test_all_children_different_parents(tmpdir):
+    filename = tmpdir.join("test.py").strpath
+
+    with open(filename, "w") as f:
+        f.write(TEST_CODE)
+
+    p1 = subprocess.Popen(f"{sys.executable} {filename}".split())
+    p2 = subprocess.Popen(f"{sys.executable} {filename}".split())
+
+    import time
+
+    time.sleep(1)
+
+    children1 = dict(all_children(psutil.Process(p1.pid)))
+    children2 = dict(all_children(psutil.Process(p2.pid)))
+    assert len(children1) > 0
+    assert len(children2) > 0
+    assert not set(children1) & set(children2)
+    assert all(child.ppid() == p2.pid for child in children2.values())
+    p1.kill()
+    p2.kill()
+
+
+def test_get_dir_size_mb(tmpdir):
+    tmpdir.join("a.bin").write_binary(b"0" * 1024**2)
+    tmpdir.mkdir("sub").mkdir("subsub").join("b.bin").write_binary(b"0" * 1024**2)
+    assert get_dir_size_mb(str(tmpdir)) == 2.0
+    assert get_dir_size_mb(tmpdir.join("missing").strpath) == 0.0
+
+
+def test_get_dir_size_mb_cached(tmpdir):
+    tmpdir.join("a.bin").write_binary(b"0" * 1024**2)
+    # Make the directory old enough for its listing to be cached
+    os.utime(tmpdir.strpath, ns=(0, 0))
+    listings = {}
+    assert get_dir_size_mb(str(tmpdir), listings) == 1.0
+    assert str(tmpdir) in listings
+    # Files growing doesn't change the directory mtime but should still be picked up
+    tmpdir.join("a.bin").write(b"0" * 1024**2, mode="ab")
+    assert get_dir_size_mb(str(tmpdir), listings) == 2.0
+    # New files change the directory mtime, so the directory is listed again
+    tmpdir.join("b.bin").write_binary(b"0" * 1024**2)
+    assert get_dir_size_mb(str(tmpdir), listings) == 3.0
+
+
+def test_process_reaped(capfd):
+    # Once the process has been reaped it no longer exists at all, which
+    # should end the monitoring in the same way as a zombie process
+    p = subprocess.Popen("sleep 1".split())
+    thread = threading.Thread(target=p.wait)
+    thread.start()
+    monitor(p.pid, interval=0.1, logfile=os.devnull)
+    thread.join()
+    assert "Process finished" in capfd.readouterr().out
+
+
+def test_process_finished_after_rows(capfd):
+    # When logging to stdout, the message should come after all the rows
+    p = subprocess.Popen("sleep 1".split())
+    thread = threading.Thread(target=p.wait)
+    thread.start()
+    monitor(p.pid, interval=0.1)
+    thread.join()
+    lines = capfd.readouterr().out.splitlines()
+    assert lines[-1].startswith("Process finished")
+    assert len(lines) > 2
+
+
 class TestMonitor:
     def setup_method(self, method):
         self.p = subprocess.Popen("sleep 10", shell=True)
@@ -46,6 +120,36 @@ class TestMonitor:
     def test_simple_with_interval(self):
         monitor(self.p.pid, duration=3, interval=0.1)
 
+    def test_stdout_text_only(self):
+        # sys.stdout may be replaced by an object without a binary buffer
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            monitor(self.p.pid, duration=1, interval=0.1)
+        lines = out.getvalue().splitlines()
+        assert lines[0].startswith("# ")
+        assert len(lines) > 1
+
+    def test_adaptive_interval(self, tmpdir):
+        # The sleeping process is idle, so the interval should back off to
+        # max_interval, which takes only 15 samples here
+        filename = tmpdir.join("test_logfile.csv").strpath
+        monitor(
+            self.p.pid,
+            logfile=filename,
+            duration=3,
+            base_interval=0.01,
+            max_interval=0.05,
+            log_format="csv",
+        )
+        with open(filename) as csvfile:
+            times = [float(row["elapsed_time"]) for row in csv.DictReader(csvfile)]
+        gaps = [t2 - t1 for t1, t2 in zip(times[:-1], times[1:])]
+        assert len(gaps) > 20
+        # The time between samples is at least the interval slept for, plus
+        # the same per-sample overhead at the start and at the end
+        assert min(gaps[-5:]) >= 0.05
+        assert sum(gaps[-5:]) > sum(gaps[:5])
+
     def test_with_children(self, tmpdir):
         # Test with current process since it has a subprocess (self.p)
         monitor(os.getpid(), duration=3, include_children=True)
@@ -54,7 +158,13 @@ class TestMonitor:
         filename = tmpdir.join("test_logfile").strpath
         monitor(self.p.pid, logfile=filename, duration=3)
         assert os.path.exists(filename)
-        assert len(open(filename).readlines()) > 0
+        assert len(open(filename).readlines()) > 1
+
+    def test_stdout(self, capfd):
+        monitor(self.p.pid, duration=1, interval=0.1)
+        lines = capfd.readouterr().out.splitlines()
+        assert lines[0].startswith("# ")
+        assert len(lines) > 1
 
     def test_logfile_csv(self, tmpdir):
         filename = tmpdir.join("test_logfile.csv").strpath
@@ -64,6 +174,32 @@ class TestMonitor:
         with open(filename) as csvfile:
             data = csv.reader(csvfile)
             assert next(data) == ["elapsed_time", "nproc", "cpu", "mem_real", "mem_virtual", "mem_swap"]
+            row = next(data)
+            assert int(row[1]) == 1
+            assert all(len(value.partition(".")[2]) <= 3 for value in row[2:])
+
+    def test_logfile_binary(self, tmpdir):
+        filename = tmpdir.join("test_logfile.bin").strpath
+        monitor(self.p.pid, logfile=filename, duration=1, log_format="binary")
+        with open(filename, "rb") as f:
+            columns = json.loads(f.readline())
+            data = f.read()
+        assert [name for name, _ in columns][:3] == ["elapsed_time", "nproc", "cpu"]
+        record_format = "<dIffff"
+        assert len(data) > 0
+        assert len(data) % struct.calcsize(record_format) == 0
+        elapsed_time, nproc, *_ = next(struct.iter_unpack(record_format, data))
+        assert elapsed_time >= 0
+        assert nproc == 1
+
+    def test_include_dir(self, tmpdir):
+        tmpdir.join("data.bin").write_binary(b"0" * 1024**2)
+        filename = tmpdir.join("test_logfile.csv").strpath
+        monitor(self.p.pid, logfile=filename, duration=1, log_format="csv", include_dir=str(tmpdir))
+        with open(filename) as csvfile:
+            rows = list(csv.DictReader(csvfile))
+        assert len(rows) > 0
+        assert float(rows[-1]["dir_size_mb"]) >= 1.0
 
     def test_plot(self, tmpdir):
         pytest.importorskip("matplotlib")
@@ -71,6 +207,16 @@ class TestMonitor:
         monitor(self.p.pid, plot=filename, duration=6)
         assert os.path.exists(filename)
 
+    def test_plot_downsampled(self, tmpdir, monkeypatch):
+        pytest.importorskip("matplotlib")
+        # Make sure the plotted samples exceed the maximum buffer size
+        main_module = sys.modules[monitor.__module__]
+        monkeypatch.setattr(main_module, "_LOG_INITIAL_SIZE", 4)
+        monkeypatch.setattr(main_module, "_LOG_MAX_SIZE", 16)
+        filename = tmpdir.join("test_plot.png").strpath
+        monitor(self.p.pid, plot=filename, duration=1, base_interval=0.001, max_interval=0.001)
+        assert os.path.exists(filename)
+
     def test_main(self):
         sys.argv = ["psrecord", "--duration=3", "'sleep 10'"]
         main()
@@ -79,6 +225,72 @@ class TestMonitor:
         sys.argv = ["psrecord", "--duration=3", str(os.getpid())]
         main()
 
+    @pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="Requires sched_setaffinity")
+    def test_pin_core_and_nice(self):
+        # Run in a separate process, since this changes the affinity and
+        # niceness of the process calling monitor()
+        core = min(os.sched_getaffinity(0))
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "psrecord",
+                "--duration=1",
+                f"--pin-core={core}",
+                "--nice=1",
+                str(self.p.pid),
+            ],
+            check=True,
+        )
+
+    @pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="Requires sched_setaffinity")
+    def test_pin_core_invalid(self):
+        # An unusable core should only result in a warning
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "psrecord",
+                "--duration=1",
+                "--pin-core=100000",
+                str(self.p.pid),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        assert "Warning: Could not pin to CPU core" in result.stdout
+
+    def test_pin_core_and_nice_overflow(self):
+        # Values that don't fit in a C integer should also only warn
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "psrecord",
+                "--duration=1",
+                f"--pin-core={2**70}",
+                f"--nice={2**40}",
+                str(self.p.pid),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        if hasattr(os, "sched_setaffinity"):
+            assert "Warning: Could not pin to CPU core" in result.stdout
+        if hasattr(os, "nice"):
+            assert "Warning: Could not change the niceness" in result.stdout
+
     @pytest.mark.skipif(sys.platform == "darwin", reason="Functionality not supported on MacOS")
     def test_io(self, tmpdir):
         monitor(os.getpid(), duration=3, include_io=True)
+
+    @pytest.mark.skipif(sys.platform == "darwin", reason="Functionality not supported on MacOS")
+    def test_io_access_denied(self, monkeypatch):
+        def io_counters(self):
+            raise psutil.AccessDenied(self.pid)
+
+        monkeypatch.setattr(psutil.Process, "io_counters", io_counters)
+        with pytest.raises(psutil.AccessDenied):
+            monitor(self.p.pid, duration=1, include_io=True)